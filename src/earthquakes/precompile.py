@@ -0,0 +1,31 @@
+"""
+Warm the on-disk cache of the numba kernels of earthquakes.tools, e.g. after installing the package, 
+so that the first computation of a run does not pay for their compilation:
+
+    python -m earthquakes.precompile
+"""
+
+import numpy as np
+
+from earthquakes import tools
+
+
+def precompile():
+    
+    """
+    Compile (or load from the cache) every CPU kernel for float32 and float64 points, 
+    both writeable and readonly (as pandas may hand out readonly arrays)
+    """
+    
+    for dtype in (np.float64, np.float32):
+        for writeable in (True, False):
+            points = np.zeros(2, dtype=dtype)
+            points.setflags(write=writeable)
+            tools.get_haversine_distance(points, points, 0, 0)
+            tools.haversine_into(tools.AssetContext.from_degrees(0, 0), points, points)
+            tools.haversine_into(tools.AssetContext.from_degrees(0, 0), points, points, cos_lats=points)
+            tools.haversine_matrix(points, points, [0], [0])
+
+
+if __name__ == "__main__":
+    precompile()
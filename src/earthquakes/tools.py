@@ -1,4 +1,4 @@
-EARTH_RADIUS = 6378
+EARTH_RADIUS = 6371 # mean radius of earth in kilometers
 
 TIME_COLUMN = "time"
 PAYOUT_COLUMN = "payout"
@@ -7,7 +7,155 @@ DISTANCE_COLUMN = "distance"
 LATITUDE_COLUMN = "latitude"
 LONGITUDE_COLUMN = "longitude"
 
+import math
+import warnings
+from dataclasses import dataclass, field
+
 import numpy as np
+import pandas as pd
+from numba import cuda, njit, prange
+
+PI_OVER_180 = math.pi / 180
+
+# number of points processed per block by haversine_matrix, small enough to keep a slab of them in L2
+HAVERSINE_BLOCK_SIZE = 4096
+# number of distances from which haversine_matrix runs on the GPU (when available), 
+# below it the host to device transfers outweigh the speedup
+GPU_MIN_SIZE = 10**7
+# shape of the blocks of threads of the GPU kernel
+GPU_THREADS_PER_BLOCK = (16, 16)
+
+
+def _float_dtype(*arrays):
+    
+    """
+    The dtype computations on the given arrays are stored in: float32 when they all are float32 
+    (halving the memory traffic), float64 otherwise
+    """
+    
+    if all(np.asarray(array).dtype == np.float32 for array in arrays):
+        return np.float32
+    return np.float64
+
+
+# the CPU kernels are compiled lazily, on their first call for each type of arguments, and cached on disk 
+# so that later runs load them from __pycache__ (see earthquakes.precompile to warm the cache)
+@njit(parallel=True, fastmath=True, cache=True)
+def _haversine_kernel(lats, lons, lat0, lon0, out):
+    
+    """
+    Fill out with the great circle distance in kilometers between each point of (lats, lons)
+    and the point (lat0, lon0), all given in decimal degrees
+    """
+    
+    # constants and asset coordinates in the dtype of the points, so that float32 points 
+    # are computed in single precision (twice as many SIMD lanes) rather than promoted to float64
+    deg = lats.dtype.type(PI_OVER_180)
+    half = lats.dtype.type(0.5)
+    diameter = lats.dtype.type(2.0 * EARTH_RADIUS)
+    lat0_t = lats.dtype.type(lat0)
+    lon0_t = lats.dtype.type(lon0)
+    cos_lat0 = math.cos(lat0_t * deg)
+    
+    for i in prange(lats.shape[0]):
+        dlat = (lats[i] - lat0_t) * deg
+        dlon = (lons[i] - lon0_t) * deg
+        s1 = math.sin(dlat * half)
+        s2 = math.sin(dlon * half)
+        a = s1 * s1 + cos_lat0 * math.cos(lats[i] * deg) * s2 * s2
+        out[i] = diameter * math.asin(math.sqrt(a))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _haversine_rad_kernel(lats_rad, lons_rad, cos_lats, lat0_rad, lon0_rad, cos_lat0, out):
+    
+    """
+    Fill out with the great circle distance in kilometers between each point of (lats_rad, lons_rad)
+    and the point (lat0_rad, lon0_rad), all given in radians, cos_lats holding the cosines of lats_rad
+    """
+    
+    # constants and asset scalars in the dtype of the points (see _haversine_kernel)
+    half = lats_rad.dtype.type(0.5)
+    diameter = lats_rad.dtype.type(2.0 * EARTH_RADIUS)
+    lat0_t = lats_rad.dtype.type(lat0_rad)
+    lon0_t = lats_rad.dtype.type(lon0_rad)
+    cos_lat0_t = lats_rad.dtype.type(cos_lat0)
+    
+    for i in prange(lats_rad.shape[0]):
+        s1 = math.sin((lats_rad[i] - lat0_t) * half)
+        s2 = math.sin((lons_rad[i] - lon0_t) * half)
+        a = s1 * s1 + cos_lat0_t * cos_lats[i] * s2 * s2
+        out[i] = diameter * math.asin(math.sqrt(a))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _haversine_matrix_kernel(lats, lons, lat0s, lon0s, out):
+    
+    """
+    Fill out[a, i] with the great circle distance in kilometers between the point (lats[i], lons[i])
+    and the point (lat0s[a], lon0s[a]), all given in decimal degrees
+    """
+    
+    n = lats.shape[0]
+    m = lat0s.shape[0]
+    
+    # constants and asset coordinates in the dtype of the points (see _haversine_kernel)
+    deg = lats.dtype.type(PI_OVER_180)
+    half = lats.dtype.type(0.5)
+    diameter = lats.dtype.type(2.0 * EARTH_RADIUS)
+    
+    # the work that depends on the points only is done once for all the assets
+    lats_r = np.empty(n, dtype=lats.dtype)
+    lons_r = np.empty(n, dtype=lats.dtype)
+    cos_lats = np.empty(n, dtype=lats.dtype)
+    for i in prange(n):
+        lats_r[i] = lats[i] * deg
+        lons_r[i] = lons[i] * deg
+        cos_lats[i] = math.cos(lats_r[i])
+    
+    lat0s_r = np.empty(m, dtype=lats.dtype)
+    lon0s_r = np.empty(m, dtype=lats.dtype)
+    cos_lat0s = np.empty(m, dtype=lats.dtype)
+    for a in range(m):
+        lat0s_r[a] = lats.dtype.type(lat0s[a]) * deg
+        lon0s_r[a] = lats.dtype.type(lon0s[a]) * deg
+        cos_lat0s[a] = math.cos(lat0s_r[a])
+    
+    # parallel over (block, asset) pairs so that a catalogue fitting in a single block still 
+    # spreads over the threads, the consecutive pairs of a thread sharing the same block of points
+    n_blocks = (n + HAVERSINE_BLOCK_SIZE - 1) // HAVERSINE_BLOCK_SIZE
+    for k in prange(n_blocks * m):
+        b = k // m
+        a = k % m
+        start = b * HAVERSINE_BLOCK_SIZE
+        stop = min(start + HAVERSINE_BLOCK_SIZE, n)
+        lat0 = lat0s_r[a]
+        lon0 = lon0s_r[a]
+        cos_lat0 = cos_lat0s[a]
+        for i in range(start, stop):
+            s1 = math.sin((lats_r[i] - lat0) * half)
+            s2 = math.sin((lons_r[i] - lon0) * half)
+            h = s1 * s1 + cos_lat0 * cos_lats[i] * s2 * s2
+            out[a, i] = diameter * math.asin(math.sqrt(h))
+
+
+@cuda.jit
+def _haversine_matrix_gpu_kernel(lats, lons, lat0s, lon0s, deg, half, diameter, out):
+    
+    """
+    GPU version of _haversine_matrix_kernel, each thread filling out[a, i], 
+    the asset coordinates and the constants being given in the dtype of the points
+    """
+    
+    a, i = cuda.grid(2)
+    if a < lat0s.shape[0] and i < lats.shape[0]:
+        lat_r = lats[i] * deg
+        lat0_r = lat0s[a] * deg
+        s1 = math.sin((lat_r - lat0_r) * half)
+        s2 = math.sin((lons[i] * deg - lon0s[a] * deg) * half)
+        h = s1 * s1 + math.cos(lat0_r) * math.cos(lat_r) * s2 * s2
+        out[a, i] = diameter * math.asin(math.sqrt(h))
+
 
 def get_haversine_distance(lats, lons, lat0, lon0):
     """
@@ -23,22 +171,309 @@ def get_haversine_distance(lats, lons, lat0, lon0):
     
     Return:
     -------
-    The great circle distance between the given points
+    The great circle distance between the given points, in float32 when the points are given in float32
+    """
+    
+    dtype = _float_dtype(lats, lons)
+    lats = np.ascontiguousarray(lats, dtype=dtype)
+    lons = np.ascontiguousarray(lons, dtype=dtype)
+
+    out = np.empty_like(lats)
+    _haversine_kernel(lats, lons, float(lat0), float(lon0), out)
+    return out
+
+
+@dataclass
+class AssetContext:
+    
+    """
+    Quantities of an asset that do not depend on the earthquakes, precomputed once 
+    so that many catalogues can be scored against the asset
+    
+    Attributes:
+    -----------
+    lat0_rad: latitude of the asset in radians
+    lon0_rad: longitude of the asset in radians
+    cos_lat0_rad: cosine of the latitude of the asset
+    buf: reusable output buffer of haversine_into, float64 by default 
+         (reallocated by the first call of haversine_into with float32 points)
+    
+    
+    """
+    
+    lat0_rad: float
+    lon0_rad: float
+    cos_lat0_rad: float
+    buf: np.ndarray = field(default_factory=lambda: np.empty(0))
+    
+    @classmethod
+    def from_degrees(cls, lat0, lon0, size=0):
+        
+        """
+        Build the context of an asset given in decimal degrees, with a buffer for size earthquakes
+        """
+        
+        lat0_rad = math.radians(lat0)
+        return cls(
+            lat0_rad=lat0_rad,
+            lon0_rad=math.radians(lon0),
+            cos_lat0_rad=math.cos(lat0_rad),
+            buf=np.empty(size),
+        )
+
+
+def haversine_into(ctx, lats_rad, lons_rad, out=None, cos_lats=None):
+    """
+    Calculate the great circle distance in kilometers between points on the earth 
+    and an asset, the points being already converted to radians and the cosines of their 
+    latitudes being given so that this work is done once per catalogue rather than once per asset
+    
+    Parameters
+    ----------
+    ctx: AssetContext of the asset from which the distance is computed
+    lats_rad: latitudes of the points in radians
+    lons_rad: longitudes of the points in radians
+    out: contiguous writeable numpy array the distances are written into, of the shape of the points 
+         and of their dtype (float32 when they all are float32, float64 otherwise), 
+         ctx.buf (reallocated if its shape or dtype do not match) when not given
+    cos_lats: np.cos(lats_rad), to be computed once per catalogue and passed for every asset, 
+              computed here when not given
+    
+    Return:
+    -------
+    out, holding the great circle distance between the points and the asset
     """
     
-    # convert decimal degrees to radians
-    lats = lats * (np.pi/180)
-    lons = lons * (np.pi/180)
-    lat0 = lat0 * (np.pi/180)
-    lon0 = lon0 * (np.pi/180)
+    dtype = _float_dtype(lats_rad, lons_rad)
+    lats_rad = np.ascontiguousarray(lats_rad, dtype=dtype)
+    lons_rad = np.ascontiguousarray(lons_rad, dtype=dtype)
+    if lats_rad.shape != lons_rad.shape:
+        raise ValueError('lats_rad and lons_rad must have the same shape')
+    if cos_lats is None:
+        cos_lats = np.cos(lats_rad)
+    else:
+        cos_lats = np.ascontiguousarray(cos_lats, dtype=dtype)
+        if cos_lats.shape != lats_rad.shape:
+            raise ValueError('cos_lats and lats_rad must have the same shape')
+    
+    if out is None:
+        if ctx.buf.shape != lats_rad.shape or ctx.buf.dtype != dtype:
+            ctx.buf = np.empty_like(lats_rad)
+        out = ctx.buf
+    elif (out.shape != lats_rad.shape or out.dtype != dtype 
+          or not out.flags.c_contiguous or not out.flags.writeable):
+        raise ValueError(
+            'out must be a contiguous writeable array of shape ' + str(lats_rad.shape) + ' and dtype ' + np.dtype(dtype).name
+        )
+    
+    _haversine_rad_kernel(lats_rad, lons_rad, cos_lats, ctx.lat0_rad, ctx.lon0_rad, ctx.cos_lat0_rad, out)
+    return out
 
-    # haversine formula 
-    dlon = lons - lon0 
-    dlat = lats - lat0
-    a = np.sin(dlat/2)**2 + np.cos(lat0) * np.cos(lats) * np.sin(dlon/2)**2
-    c = 2 * np.arcsin(np.sqrt(a)) 
-    r = EARTH_RADIUS # Radius of earth in kilometers
-    return c * r
+
+def haversine_matrix(lats, lons, lat0s, lon0s):
+    """
+    Calculate the great circle distance in kilometers between every point of a set 
+    and every point of a second set on the earth (specified in decimal degrees), 
+    on the GPU for large sets when CUDA is available and on the CPU otherwise
+    
+    Parameters
+    ----------
+    lats: latitudes of points that their distance from the given points are computed
+          (may be a CUDA device array, kept on the GPU across calls)
+    lons: longitudes of points that their distance from the given points are computed
+          (may be a CUDA device array, kept on the GPU across calls)
+    lat0s: latitudes of the given points from which the distances are computed 
+    lon0s: longitudes of the given points from which the distances are computed
+    
+    Return:
+    -------
+    2d numpy array of shape (len(lat0s), len(lats)) whose row a holds the great circle distance 
+    between the points and the given point a, in float32 when the points are given in float32
+    """
+    
+    lat0s = np.ascontiguousarray(lat0s, dtype=np.float64)
+    lon0s = np.ascontiguousarray(lon0s, dtype=np.float64)
+    
+    # arrays exposing the CUDA array interface (numba device arrays, CuPy arrays) are already on the GPU
+    on_device = hasattr(lats, '__cuda_array_interface__') and hasattr(lons, '__cuda_array_interface__')
+    if on_device or (cuda.is_available() and lat0s.shape[0] * len(lats) >= GPU_MIN_SIZE):
+        return _haversine_matrix_gpu(lats, lons, lat0s, lon0s)
+
+    dtype = _float_dtype(lats, lons)
+    lats = np.ascontiguousarray(lats, dtype=dtype)
+    lons = np.ascontiguousarray(lons, dtype=dtype)
+
+    out = np.empty((lat0s.shape[0], lats.shape[0]), dtype=dtype)
+    _haversine_matrix_kernel(lats, lons, lat0s, lon0s, out)
+    return out
+
+
+def _haversine_matrix_gpu(lats, lons, lat0s, lon0s):
+    
+    """
+    Run haversine_matrix on the GPU, copying to the device the arrays that are not there yet
+    """
+    
+    if not hasattr(lats, '__cuda_array_interface__'):
+        lats = cuda.to_device(np.ascontiguousarray(lats, dtype=_float_dtype(lats, lons)))
+    if not hasattr(lons, '__cuda_array_interface__'):
+        lons = cuda.to_device(np.ascontiguousarray(lons, dtype=lats.dtype))
+    
+    m = lat0s.shape[0]
+    n = lats.shape[0]
+    out = cuda.device_array((m, n), dtype=lats.dtype)
+    
+    blocks_per_grid = (
+        (m + GPU_THREADS_PER_BLOCK[0] - 1) // GPU_THREADS_PER_BLOCK[0],
+        (n + GPU_THREADS_PER_BLOCK[1] - 1) // GPU_THREADS_PER_BLOCK[1],
+    )
+    # constants and asset coordinates in the dtype of the points, float64 ones would promote 
+    # the float32 arithmetic of the kernel to float64 (see _haversine_kernel)
+    scalar = lats.dtype.type
+    _haversine_matrix_gpu_kernel[blocks_per_grid, GPU_THREADS_PER_BLOCK](
+        lats,
+        lons,
+        cuda.to_device(lat0s.astype(lats.dtype)),
+        cuda.to_device(lon0s.astype(lats.dtype)),
+        scalar(PI_OVER_180),
+        scalar(0.5),
+        scalar(2.0 * EARTH_RADIUS),
+        out,
+    )
+    return out.copy_to_host()
+
+
+def _build_payout_table(radii, mags, payouts):
+    
+    """
+    Build a lookup table of the largest payout an earthquake qualifies for
+    
+    Parameters:
+    -----------
+    radii: numpy array of the radius (distance) of each payout tier
+    mags: numpy array of the magnitude of each payout tier
+    payouts: numpy array of the payout of each payout tier
+    
+    Returns:
+    --------
+    the sorted unique radii, the sorted unique magnitudes and a table such that 
+    table[np.searchsorted(sorted_radii, dist, side='left'), np.searchsorted(sorted_mags, mg, side='right')]
+    is the largest payout among the tiers with radius >= dist and magnitude <= mg (0 if there is none), 
+    the row sorted_radii.size and the column 0 holding zero payouts
+    
+    
+    """
+    
+    sorted_radii, r_inv = np.unique(radii, return_inverse=True)
+    sorted_mags, m_inv = np.unique(mags, return_inverse=True)
+    
+    # the extra last row stands for distances beyond the largest radius and
+    # the extra first column for magnitudes below the smallest magnitude
+    table = np.zeros((sorted_radii.size + 1, sorted_mags.size + 1))
+    np.maximum.at(table, (r_inv, m_inv + 1), payouts)
+    
+    # a tier of radius R also covers every smaller radius,
+    # and a tier of magnitude M also covers every larger magnitude
+    table = np.maximum.accumulate(table[::-1], axis=0)[::-1]
+    table = np.maximum.accumulate(table, axis=1)
+    
+    return sorted_radii, sorted_mags, table
+
+
+def get_years(times):
+    
+    """
+    To extract the year of each earthquake time
+    
+    Parameters:
+    -----------
+    times: pd.Series or numpy array of datetimes or of ISO 8601 strings (as given by USGS, e.g. 2021-10-12T09:24:05.099Z)
+    
+    Returns:
+    --------
+    numpy array of the years as integers
+    
+    
+    """
+    
+    if pd.api.types.is_datetime64_any_dtype(times):
+        return pd.DatetimeIndex(times).year.to_numpy()
+    
+    # the year is the first 4 characters of an ISO 8601 string, truncating to a 4 characters 
+    # numpy string keeps the slicing and the conversion to integers in C
+    return np.asarray(times, dtype='U4').astype(np.int64)
+
+
+def get_payout_tiers(payouts_str):
+    
+    """
+    To convert the payout structure into arrays, once for repeated calls of compute_payouts_from_arrays
+    
+    Parameters:
+    -----------
+    payout_str: pd.dataframe containing the radius (distance) and magintude and thier corresponding payout
+    
+    Returns:
+    --------
+    the radii, the magnitudes and the payouts of the tiers as float64 numpy arrays
+    
+    
+    """
+    
+    radii = payouts_str['Radius'].to_numpy(np.float64)
+    mags = payouts_str['Magnitude'].to_numpy(np.float64)
+    payouts = payouts_str['Payout'].to_numpy(np.float64)
+    return radii, mags, payouts
+
+
+def compute_payouts_from_arrays(times, mags_q, dists_q, radii, mags_t, pay_t):
+    
+    """
+    To compute the amount of payout for each given year from arrays, without any access to a dataframe
+    
+    Parameters:
+    -----------
+    times: times of the earthquakes (see get_years)
+    mags_q: magnitudes of the earthquakes
+    dists_q: distances of the earthquakes
+    radii: radius (distance) of each payout tier
+    mags_t: magnitude of each payout tier
+    pay_t: payout of each payout tier
+    
+    Returns:
+    --------
+    the given years (int32 numpy array, in ascending order) and their amount of payouts (float64 numpy array)
+    
+    
+    """
+    
+    # compare each tier column in the precision of the catalogue column it is compared against,
+    # so that e.g. a float32 magnitude of 4.6 still reaches a tier of magnitude 4.6
+    mg = np.asarray(mags_q, dtype=_float_dtype(mags_q))
+    dist = np.asarray(dists_q, dtype=_float_dtype(dists_q))
+    years = get_years(times)
+    
+    radii = np.asarray(radii, dtype=dist.dtype)
+    mags = np.asarray(mags_t, dtype=mg.dtype)
+    payouts = np.asarray(pay_t, dtype=np.float64)
+    
+    # payout of each earthquake: the largest payout among the tiers it qualifies for,
+    # i.e. the tiers with a radius >= dist and a magnitude <= mg
+    sorted_radii, sorted_mags, table = _build_payout_table(radii, mags, payouts)
+    r_idx = np.searchsorted(sorted_radii, dist, side='left')
+    m_idx = np.searchsorted(sorted_mags, mg, side='right')
+    # np.searchsorted places NaN after every tier, a NaN distance or magnitude 
+    # qualifies for no tier: point it to the padding row / column of zero payout
+    r_idx[np.isnan(dist)] = sorted_radii.size
+    m_idx[np.isnan(mg)] = 0
+    per_quake = table[r_idx, m_idx]
+    
+    # payout of each year: the largest payout among its earthquakes
+    uy, inv = np.unique(years, return_inverse=True)
+    result = np.zeros(uy.size)
+    np.maximum.at(result, inv, per_quake)
+    
+    return uy.astype(np.int32), result
 
 
 def compute_payouts(earthquake_data, payouts_str):
@@ -53,41 +488,38 @@ def compute_payouts(earthquake_data, payouts_str):
     
     Returns:
     --------
-    Python dictionary containing the given years and their amount of payouts
+    the given years (int32 numpy array, in ascending order) and their amount of payouts (float64 numpy array)
     
     
     """
     
-    payout_years = {}
+    return compute_payouts_from_arrays(
+        earthquake_data[TIME_COLUMN],
+        earthquake_data[MAGNITUDE_COLUMN].to_numpy(),
+        earthquake_data[DISTANCE_COLUMN].to_numpy(),
+        *get_payout_tiers(payouts_str),
+    )
+
+
+def compute_payouts_dict(earthquake_data, payouts_str):
     
-    for t, mg , dist in earthquake_data[[TIME_COLUMN, MAGNITUDE_COLUMN, DISTANCE_COLUMN]].values:
-        year = int(t[0:4])
-        
-        payout = 0
-        for dist_str, mg_str, payout_str in payouts_str[['Radius', 'Magnitude', 'Payout']].values:
-            if (float(dist) <= float(dist_str)) and (float(mg) >= float(mg_str)):
-                if payout < payout_str:
-                    payout = payout_str
-                    
-        if year in payout_years:
-            if payout_years[year] < payout:
-                payout_years[year] = payout
-          
-        else:
-            payout_years[year]  = payout
-        
-        
-    return payout_years
+    """
+    Same as compute_payouts, returning a Python dictionary containing the given years and their amount of payouts
+    """
+    
+    years, payouts = compute_payouts(earthquake_data, payouts_str)
+    return dict(zip(years.tolist(), payouts.tolist()))
                 
     
 def compute_burning_cost(payouts, start_year=1952, end_year=2021):
     
     """
-    To compute the burning cost (the average of payouts over a time range) given a payout dictionary
+    To compute the burning cost (the average of payouts over a time range) given the payouts of each year
     
     Parameters:
     -----------
-    payouts: python dictionary containing the given years and their amount of payouts
+    payouts: (years, payouts) numpy arrays as returned by compute_payouts, 
+             or python dictionary / pd.Series containing the given years and their amount of payouts
     start_year: the start of the time range in years
     end_year: the end of the time range in years
     
@@ -98,23 +530,19 @@ def compute_burning_cost(payouts, start_year=1952, end_year=2021):
     
     """
     
-    payout_years = list(payouts.keys())
-    
-    burn = []
-    for year in payout_years:
-        if (year >= start_year) and (year <= end_year):
-            burn.append(payouts[year])
-    
-    if len(burn) < 1:
-        print('the time limits entered does not correspond to any data in the payout dictionary')
-        return None
+    if isinstance(payouts, tuple):
+        years = np.asarray(payouts[0])
+        values = np.asarray(payouts[1], dtype=np.float64)
     else:
-        burning_cost = np.asarray(burn).sum() /  (end_year - start_year + 1)
-        return burning_cost
-    
-                
-        
-        
-        
+        # a python dictionary or a pd.Series indexed by year
+        payouts = pd.Series(payouts, dtype=np.float64)
+        years = payouts.index.to_numpy(dtype=np.int32)
+        values = payouts.to_numpy()
     
+    mask = (years >= start_year) & (years <= end_year)
+    if not mask.any():
+        warnings.warn('the time limits entered does not correspond to any data in the payout dictionary')
+        return None
     
+    burning_cost = values[mask].sum() / (end_year - start_year + 1)
+    return burning_cost
@@ -1,17 +1,109 @@
 import datetime
-import urllib
-import os
+import urllib.parse
+import urllib.request
+import urllib.error
 import pandas as pd
 import asyncio
 import aiohttp
 import io
+import warnings
+import pyarrow as pa
+import pyarrow.csv as pv
 
+USGS_QUERY_URL = 'https://earthquake.usgs.gov/fdsnws/event/1/query?'
 
-def build_api_url(latitude,longitude,radius,minimum_magnitude,end_date):
+# maximum number of simultaneous requests sent to USGS
+MAX_CONCURRENT_REQUESTS = 8
+# total timeout of a request in seconds
+REQUEST_TIMEOUT = 120
+# http statuses of the requests that are retried, and the backoff in seconds before the first retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1
+
+# columns of the USGS csv catalogues, in their order in the csv
+USGS_CSV_COLUMNS = ['time', 'latitude', 'longitude', 'depth', 'mag', 'magType', 'nst', 'gap', 'dmin', 'rms', 
+                    'net', 'id', 'updated', 'place', 'type', 'horizontalError', 'depthError', 'magError', 
+                    'magNst', 'status', 'locationSource', 'magSource']
+# dtypes of the numeric columns of the USGS csv catalogues, given to pd.read_csv to skip type inference
+USGS_CSV_DTYPES = {
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'depth': 'float64',
+    'mag': 'float64',
+    'nst': 'float64',
+    'gap': 'float64',
+    'dmin': 'float64',
+    'rms': 'float64',
+    'horizontalError': 'float64',
+    'depthError': 'float64',
+    'magError': 'float64',
+    'magNst': 'float64',
+}
+# text columns of the USGS csv catalogues, kept as strings (pyarrow would otherwise parse the dates)
+USGS_CSV_STRING_COLUMNS = ['time', 'magType', 'net', 'id', 'updated', 'place', 'type',
+                           'status', 'locationSource', 'magSource']
+# column types given to pyarrow, every column being typed so that empty catalogues share the same schema
+USGS_ARROW_COLUMN_TYPES = {
+    **{column: pa.float64() for column in USGS_CSV_DTYPES},
+    **{column: pa.string() for column in USGS_CSV_STRING_COLUMNS},
+}
+# columns used in the distance and payout computations, which do not need more than float32 precision
+USGS_FLOAT32_COLUMNS = ['latitude', 'longitude', 'depth', 'mag']
+
+
+def get_csv_dtypes(float32=False):
     
     """
-    Build url to retrieve a catalogue of earthquakes that took place in a give region from 200 year 
-    before a given date from USGS database
+    The dtypes given to pd.read_csv for the numeric columns of the USGS catalogues
+    """
+    
+    if not float32:
+        return USGS_CSV_DTYPES
+    return {**USGS_CSV_DTYPES, **{column: 'float32' for column in USGS_FLOAT32_COLUMNS}}
+
+
+def get_arrow_column_types(float32=False):
+    
+    """
+    The column types given to the pyarrow csv reader for the USGS catalogues
+    """
+    
+    if not float32:
+        return USGS_ARROW_COLUMN_TYPES
+    return {**USGS_ARROW_COLUMN_TYPES, **{column: pa.float32() for column in USGS_FLOAT32_COLUMNS}}
+
+
+def get_date_range(end_date, years=200):
+    
+    """
+    Format the dates bounding the retrieval of a catalogue, to be computed once and shared by every region
+    
+    Parameters
+    ----------
+    end_date: the date where data from the given number of years before are retrieved (datetime.datetime)
+    years: the number of years covered by the catalogue (int)
+    
+    Returns
+    --------
+    the start and the end dates as "%Y-%m-%d" strings
+    
+    """
+    
+    try:
+        start_date = end_date.replace(year=end_date.year - years)
+    except ValueError:
+        # the 29th of february of a leap year, whose counterpart year is not a leap year
+        start_date = end_date.replace(year=end_date.year - years, day=28)
+    
+    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+
+
+def build_api_url(latitude,longitude,radius,minimum_magnitude,end_date_str,start_date_str):
+    
+    """
+    Build url to retrieve a catalogue of earthquakes that took place in a give region between two dates 
+    from USGS database
     
     Parameters
     ----------
@@ -19,7 +111,8 @@ def build_api_url(latitude,longitude,radius,minimum_magnitude,end_date):
     longitude: longitude of region central point in degrees (float or int)
     radius: the maximum radius from the central point defining the retrieval region in km (float or int)
     minimum_magnitude: the minimum magnitude of earthquake below which data are not retrieved (float or int)
-    end_date: the date where data from 200 year before are retrieved (datetime.datetime)
+    end_date_str: the date until which data are retrieved ("%Y-%m-%d" string)
+    start_date_str: the date from which data are retrieved ("%Y-%m-%d" string)
     
     Returns
     --------
@@ -27,32 +120,26 @@ def build_api_url(latitude,longitude,radius,minimum_magnitude,end_date):
     
     Example
     --------
-    ret_url = get_earthquake_data(-20,-175,1000,3,datetime(year=2021, month=10, day=21))
+    start_date_str, end_date_str = get_date_range(datetime(year=2021, month=10, day=21))
+    ret_url = build_api_url(-20,-175,1000,3,end_date_str,start_date_str)
     
     """
-                  
-                  
-    st_date = end_date - datetime.timedelta(days=(200*365.24))
-    st_date = st_date.strftime("%Y-%m-%d")
-
-    end_date = end_date.strftime("%Y-%m-%d")
-
-    minimum_magnitude = str(minimum_magnitude)
-    radius = str(radius)
-    latitude = str(latitude)
-    longitude = str(longitude)
-
-    usgs_page = 'https://earthquake.usgs.gov/fdsnws/event/1/query?format=csv'
-
-    url = usgs_page + '&starttime=' + st_date + '&endtime=' + end_date + '&minmagnitude=' + minimum_magnitude + '&latitude=' + latitude + '&longitude=' + longitude + '&maxradiuskm=' + radius
-                
-                
-    return url
+    
+    return USGS_QUERY_URL + urllib.parse.urlencode({
+        'format': 'csv',
+        'starttime': start_date_str,
+        'endtime': end_date_str,
+        'minmagnitude': minimum_magnitude,
+        'latitude': latitude,
+        'longitude': longitude,
+        'maxradiuskm': radius,
+    })
                   
 
 def get_earthquake_data(latitude=-20,longitude=-175,
                         radius=1000,minimum_magnitude=5,
-                        end_date=datetime.datetime(year=2021, month=10, day=21)):
+                        end_date=datetime.datetime(year=2021, month=10, day=21),
+                        float32=False):
     
     """
     Retrieve a catalogue of earthquakes that took place in a given region from 200 year 
@@ -65,6 +152,7 @@ def get_earthquake_data(latitude=-20,longitude=-175,
     radius: the maximum radius from the central point defining the retrieval region in km (float or int)
     minimum_magnitude: the minimum magnitude of earthquake below which data are not retrieved (float or int)
     end_date: the date where data from 200 year before are retrieved (datetime.datetime)
+    float32: whether to store the latitude, longitude, depth and magnitude in float32 rather than float64 (bool)
     
     Returns
     --------
@@ -83,40 +171,110 @@ def get_earthquake_data(latitude=-20,longitude=-175,
     """
     
 
-    download_url = build_api_url(latitude,longitude,radius,minimum_magnitude,end_date)
-    
-    end_date = end_date.strftime("%Y-%m-%d")
-
-    minimum_magnitude = str(minimum_magnitude)
-    radius = str(radius)
-    latitude = str(latitude)
-    longitude = str(longitude)
-    
-    cwd = os.getcwd()
-    cwd = cwd + '/'
-    cat_name = 'Earthquake_cat_mMw'+minimum_magnitude+'_Clat'+latitude+'d_clon'+longitude+'d_Mrad'+radius+'km_EndDate'+end_date+'.csv'
+    start_date_str, end_date_str = get_date_range(end_date)
+    download_url = build_api_url(latitude,longitude,radius,minimum_magnitude,end_date_str,start_date_str)
     
     try:
-        urllib.request.urlretrieve(download_url, cwd + cat_name)
-        cat = pd.read_csv(cwd + cat_name)
+        # parse the response as it is streamed rather than going through a file on disk
+        with urllib.request.urlopen(download_url) as resp:
+            try:
+                cat = pd.read_csv(resp, dtype=get_csv_dtypes(float32))
+            except pd.errors.EmptyDataError:
+                # USGS answers a region without any earthquake with 204 No Content and an empty body
+                cat = pd.read_csv(io.StringIO(','.join(USGS_CSV_COLUMNS)), dtype=get_csv_dtypes(float32))
         print('worked')
         return cat
         
-    except:
+    except urllib.error.URLError:
         print('did not work')
-        return download_url, cat_name
+        return download_url
     
 
        
-async def fetch_file(url, session):
-        async with session.get(url) as resp:
-            assert resp.status == 200
-            catalogue = await resp.read()
-            return catalogue.decode()
+def read_catalogue(catalogue, float32=False):
+    
+    """
+    Parse a catalogue downloaded from USGS with the multithreaded pyarrow csv reader
+    
+    Parameters
+    ----------
+    catalogue: the catalogue in csv format (bytes)
+    float32: whether to store the latitude, longitude, depth and magnitude in float32 rather than float64 (bool)
+    
+    Returns
+    --------
+    the catalogue as a pyarrow.Table
+    
+    """
+    
+    column_types = get_arrow_column_types(float32)
+    
+    # USGS answers a region without any earthquake with 204 No Content and an empty body
+    if not catalogue:
+        return pa.schema([(column, column_types[column]) for column in USGS_CSV_COLUMNS]).empty_table()
+    
+    return pv.read_csv(
+        pa.py_buffer(catalogue),
+        read_options=pv.ReadOptions(use_threads=True),
+        convert_options=pv.ConvertOptions(column_types=column_types),
+    )
+
+
+async def fetch_file(url, session, semaphore, max_retries=MAX_RETRIES):
+    
+    """
+    Download a catalogue, retrying with an exponential backoff when USGS rate-limits 
+    the request (429) or fails on its side (5xx)
+    
+    Parameters
+    ----------
+    url: the retrieval url of the catalogue
+    session: the aiohttp.ClientSession used for the request
+    semaphore: the asyncio.Semaphore bounding the number of concurrent requests
+    max_retries: the maximum number of retries before giving up
+    
+    Returns
+    --------
+    the catalogue in csv format (bytes)
+    
+    """
+    
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            async with session.get(url) as resp:
+                if resp.status not in RETRY_STATUSES or attempt == max_retries:
+                    resp.raise_for_status()
+                    return await resp.read()
+                
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+async def fetch_and_parse(url, session, semaphore, float32=False):
+    
+    """
+    Download a catalogue and parse it off the event loop as soon as it arrived, 
+    so that parsing it overlaps with the downloads of the other catalogues
+    
+    Parameters
+    ----------
+    url: the retrieval url of the catalogue
+    session: the aiohttp.ClientSession used for the request
+    semaphore: the asyncio.Semaphore bounding the number of concurrent requests
+    float32: whether to store the latitude, longitude, depth and magnitude in float32 rather than float64 (bool)
+    
+    Returns
+    --------
+    the catalogue as a pyarrow.Table
+    
+    """
+    
+    catalogue = await fetch_file(url, session, semaphore)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, read_catalogue, catalogue, float32)
 
         
 async def get_earthquake_data_for_multiple_locations(assets, radius=200, minimum_magnitude=4.5, 
-    end_date=datetime.datetime(year=2021, month=10, day=21)):
+    end_date=datetime.datetime(year=2021, month=10, day=21), float32=False):
 
     """
     Retrieve a catalogue of earthquakes that took place in a given list of region from 200 year 
@@ -128,6 +286,7 @@ async def get_earthquake_data_for_multiple_locations(assets, radius=200, minimum
     radius: the maximum radius from the central point defining the retrieval region in km (float or int)
     minimum_magnitude: the minimum magnitude of earthquake below which data are not retrieved (float or int)
     end_date: the date where data from 200 year before are retrieved (datetime.datetime)
+    float32: whether to store the latitude, longitude, depth and magnitude in float32 rather than float64 (bool)
     
     Returns
     --------
@@ -136,28 +295,34 @@ async def get_earthquake_data_for_multiple_locations(assets, radius=200, minimum
     
     """
     
-    cwd = os.getcwd()
-    cwd = cwd + '/'
-    async with aiohttp.ClientSession() as session:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    start_date_str, end_date_str = get_date_range(end_date)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
         list_requests = []
         for latitude, longitude in assets.tolist():
-            download_url = build_api_url(latitude,longitude,radius,minimum_magnitude,end_date)
+            download_url = build_api_url(latitude,longitude,radius,minimum_magnitude,end_date_str,start_date_str)
 
-            list_requests.append(asyncio.ensure_future(fetch_file(download_url, session)))
+            list_requests.append(asyncio.ensure_future(fetch_and_parse(download_url, session, semaphore, float32)))
                                 
-        list_catalogues = await asyncio.gather(*list_requests)
-                                 
-        Eq_catalogues = None
-        for catalogue in list_catalogues:
-            catalogue = pd.read_csv(io.StringIO(catalogue))
-            
-            if Eq_catalogues is None:
-               Eq_catalogues = catalogue
-            else:
-                Eq_catalogues = pd.concat([Eq_catalogues, catalogue])
-                Eq_catalogues = Eq_catalogues.drop_duplicates()
-                Eq_catalogues = Eq_catalogues.reset_index(drop = True)
-                        
-        
+        results = await asyncio.gather(*list_requests, return_exceptions=True)
+    
+    # a failing region should not discard the catalogues of the other ones
+    frames = []
+    for result in results:
+        if isinstance(result, Exception):
+            warnings.warn('the retrieval of a catalogue failed (' + type(result).__name__ + '): ' + str(result))
+        else:
+            frames.append(result)
+    
+    if not frames:
+        return None
+    
+    # merge once at the end rather than re-scanning the growing catalogue for each region, 
+    # an earthquake found by several regions being identified by its USGS event id alone
+    Eq_catalogues = pa.concat_tables(frames)
+    is_first = ~Eq_catalogues.column('id').to_pandas().duplicated(keep='first').to_numpy()
+    Eq_catalogues = Eq_catalogues.filter(pa.array(is_first)).to_pandas()
     
-    return Eq_catalogues
\ No newline at end of file
+    return Eq_catalogues
@@ -0,0 +1,277 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import earthquakes
+from earthquakes.tools import (
+    EARTH_RADIUS,
+    HAVERSINE_BLOCK_SIZE,
+    AssetContext,
+    compute_burning_cost,
+    compute_payouts,
+    compute_payouts_from_arrays,
+    get_haversine_distance,
+    haversine_into,
+    haversine_matrix,
+)
+
+
+PAYOUT_STRUCTURE = pd.DataFrame([
+        [10, 4.5, 100],
+        [50, 5.5, 75],
+        [200, 6.5, 50],
+    ],
+    columns=['Radius', 'Magnitude', 'Payout']
+)
+
+
+def random_points(n=1000, seed=0):
+    random_state = np.random.RandomState(seed)
+    return random_state.uniform(-90, 90, n), random_state.uniform(-180, 180, n)
+
+
+def test_get_haversine_distance_known_distances():
+    lats = np.array([0, 0, 90, 0, -90])
+    lons = np.array([0, 1, 0, 180, 0])
+
+    distances = get_haversine_distance(lats, lons, 0, 0)
+
+    np.testing.assert_allclose(
+        distances,
+        [0, np.pi * EARTH_RADIUS / 180, np.pi * EARTH_RADIUS / 2, np.pi * EARTH_RADIUS, np.pi * EARTH_RADIUS / 2],
+        atol=1e-6,
+    )
+    # 1 degree of longitude along the equator
+    np.testing.assert_allclose(distances[1], 111.195, atol=1e-3)
+
+
+def test_get_haversine_distance_matches_spherical_law_of_cosines():
+    lats, lons = random_points()
+    lat0, lon0 = 35.025, 25.763
+
+    phi, phi0 = np.radians(lats), np.radians(lat0)
+    central_angle = np.arccos(
+        np.clip(np.sin(phi) * np.sin(phi0) + np.cos(phi) * np.cos(phi0) * np.cos(np.radians(lons - lon0)), -1, 1)
+    )
+
+    np.testing.assert_allclose(get_haversine_distance(lats, lons, lat0, lon0), EARTH_RADIUS * central_angle, atol=1e-3)
+
+
+# a catalogue within a single block of haversine_matrix, and one spanning several (partial) blocks
+@pytest.mark.parametrize("n", [1000, 2 * HAVERSINE_BLOCK_SIZE + 7])
+def test_haversine_functions_agree(n):
+    lats, lons = random_points(n)
+    assets = np.array([[35.025, 25.763], [-20, -175], [89.9, 0]])
+
+    matrix = haversine_matrix(lats, lons, assets[:, 0], assets[:, 1])
+    assert matrix.shape == (len(assets), len(lats))
+
+    # the conversion to radians and the cosines of the latitudes shared by all the assets
+    lats_rad, lons_rad = np.radians(lats), np.radians(lons)
+    cos_lats = np.cos(lats_rad)
+
+    for row, (lat0, lon0) in zip(matrix, assets):
+        distances = get_haversine_distance(lats, lons, lat0, lon0)
+        np.testing.assert_allclose(row, distances, rtol=1e-12, atol=1e-9)
+
+        ctx = AssetContext.from_degrees(lat0, lon0)
+        np.testing.assert_allclose(haversine_into(ctx, lats_rad, lons_rad), distances, rtol=1e-12, atol=1e-9)
+        np.testing.assert_allclose(
+            haversine_into(ctx, lats_rad, lons_rad, cos_lats=cos_lats), distances, rtol=1e-12, atol=1e-9
+        )
+
+
+def test_haversine_into_validates_its_arguments():
+    lats, lons = random_points()
+    lats_rad, lons_rad = np.radians(lats), np.radians(lons)
+    ctx = AssetContext.from_degrees(35.025, 25.763)
+
+    with pytest.raises(ValueError):
+        haversine_into(ctx, lats_rad, lons_rad[:-1])
+    with pytest.raises(ValueError):
+        haversine_into(ctx, lats_rad, lons_rad, cos_lats=np.cos(lats_rad[:-1]))
+    with pytest.raises(ValueError):
+        haversine_into(ctx, lats_rad, lons_rad, out=np.empty(len(lats), dtype=np.float32))
+
+
+def test_haversine_float32():
+    lats, lons = random_points()
+    lats32, lons32 = lats.astype(np.float32), lons.astype(np.float32)
+    expected = get_haversine_distance(lats32.astype(np.float64), lons32.astype(np.float64), 35.025, 25.763)
+
+    distances = get_haversine_distance(lats32, lons32, 35.025, 25.763)
+    matrix = haversine_matrix(lats32, lons32, [35.025], [25.763])
+    into = haversine_into(
+        AssetContext.from_degrees(35.025, 25.763),
+        np.radians(lats32),
+        np.radians(lons32),
+        cos_lats=np.cos(np.radians(lats32)),
+    )
+
+    for result in (distances, matrix[0], into):
+        assert result.dtype == np.float32
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-2)
+
+
+# run in a subprocess as the CUDA simulator has to be enabled before numba is imported
+GPU_SIMULATOR_SCRIPT = """
+import numpy as np
+from numba import cuda
+
+from earthquakes import tools
+
+tools.GPU_MIN_SIZE = 0
+random_state = np.random.RandomState(0)
+lats = random_state.uniform(-90, 90, 40)
+lons = random_state.uniform(-180, 180, 40)
+lat0s = np.array([35.025, -20, 89.9])
+lon0s = np.array([25.763, -175, 0])
+
+for dtype in (np.float64, np.float32):
+    lats_t, lons_t = lats.astype(dtype), lons.astype(dtype)
+    expected = np.empty((len(lat0s), len(lats)), dtype=dtype)
+    tools._haversine_matrix_kernel(lats_t, lons_t, lat0s, lon0s, expected)
+
+    for points in ((lats_t, lons_t), (cuda.to_device(lats_t), cuda.to_device(lons_t))):
+        matrix = tools.haversine_matrix(*points, lat0s, lon0s)
+        assert matrix.dtype == dtype, matrix.dtype
+        np.testing.assert_allclose(matrix, expected, rtol=1e-5, atol=1e-2)
+"""
+
+
+def test_haversine_matrix_gpu_matches_cpu():
+    env = dict(
+        os.environ,
+        NUMBA_ENABLE_CUDASIM='1',
+        PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(earthquakes.__file__))),
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', GPU_SIMULATOR_SCRIPT], env=env, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_get_haversine_distance_readonly_series():
+    lats, lons = random_points()
+    expected = get_haversine_distance(lats, lons, 35.025, 25.763)
+    lats.setflags(write=False)
+    lons.setflags(write=False)
+    earthquake_data = pd.DataFrame({'latitude': lats, 'longitude': lons})
+
+    distances = get_haversine_distance(earthquake_data['latitude'], earthquake_data['longitude'], 35.025, 25.763)
+
+    assert isinstance(distances, np.ndarray)
+    np.testing.assert_array_equal(distances, expected)
+    np.testing.assert_array_equal(get_haversine_distance(lats, lons, 35.025, 25.763), expected)
+
+
+def test_compute_payouts_nan_magnitude_or_distance_pays_nothing():
+    earthquake_data = pd.DataFrame({
+        'time': ['2000-01-01T00:00:00.000Z', '2001-01-01T00:00:00.000Z'],
+        'mag': [np.nan, 7.0],
+        'distance': [5.0, np.nan],
+    })
+
+    years, payouts = compute_payouts(earthquake_data, PAYOUT_STRUCTURE)
+
+    np.testing.assert_array_equal(years, [2000, 2001])
+    np.testing.assert_array_equal(payouts, [0, 0])
+
+
+def brute_force_payouts(years, mags_q, dists_q, radii, mags_t, pay_t):
+    payout_years = {}
+    for year, mg, dist in zip(years, mags_q, dists_q):
+        payout = 0
+        for radius, magnitude, tier_payout in zip(radii, mags_t, pay_t):
+            if dist <= radius and mg >= magnitude:
+                payout = max(payout, tier_payout)
+        payout_years[year] = max(payout_years.get(year, 0), payout)
+    return payout_years
+
+
+def check_against_brute_force(years, mags_q, dists_q, radii, mags_t, pay_t):
+    times = np.array([str(year) + '-06-01T00:00:00.000Z' for year in years])
+    got_years, got_payouts = compute_payouts_from_arrays(times, mags_q, dists_q, radii, mags_t, pay_t)
+
+    # each tier column is compared in the precision of the catalogue column it is compared against
+    expected = brute_force_payouts(
+        years, mags_q, dists_q, np.asarray(radii, dtype=dists_q.dtype), np.asarray(mags_t, dtype=mags_q.dtype), pay_t
+    )
+    assert dict(zip(got_years.tolist(), got_payouts.tolist())) == expected
+
+
+@pytest.mark.parametrize("mag_dtype, dist_dtype", [
+    (np.float64, np.float64), (np.float32, np.float32), (np.float32, np.float64), (np.float64, np.float32),
+])
+def test_compute_payouts_from_arrays_boundary_ties(mag_dtype, dist_dtype):
+    # earthquakes exactly on a tier radius and / or on a tier magnitude qualify for the tier
+    years = [2000, 2001, 2002, 2003]
+    mags_q = np.array([4.5, 5.5, 6.5, 5.5], dtype=mag_dtype)
+    dists_q = np.array([10, 50, 200, 10], dtype=dist_dtype)
+
+    check_against_brute_force(years, mags_q, dists_q, *PAYOUT_STRUCTURE.to_numpy().T)
+    _, payouts = compute_payouts_from_arrays(
+        [str(year) for year in years], mags_q, dists_q, *PAYOUT_STRUCTURE.to_numpy().T
+    )
+    np.testing.assert_array_equal(payouts, [100, 75, 50, 100])
+
+
+@pytest.mark.parametrize("mag_dtype, dist_dtype", [
+    (np.float64, np.float64), (np.float32, np.float32), (np.float32, np.float64), (np.float64, np.float32),
+])
+def test_compute_payouts_from_arrays_no_qualifying_tier(mag_dtype, dist_dtype):
+    years = [2000, 2000, 2001]
+    mags_q = np.array([4.4, 7.0, 6.4], dtype=mag_dtype)
+    dists_q = np.array([5, 200.5, 60], dtype=dist_dtype)
+
+    check_against_brute_force(years, mags_q, dists_q, *PAYOUT_STRUCTURE.to_numpy().T)
+    _, payouts = compute_payouts_from_arrays(
+        [str(year) for year in years], mags_q, dists_q, *PAYOUT_STRUCTURE.to_numpy().T
+    )
+    np.testing.assert_array_equal(payouts, [0, 0])
+
+
+@pytest.mark.parametrize("mag_dtype, dist_dtype", [
+    (np.float64, np.float64), (np.float32, np.float32), (np.float32, np.float64), (np.float64, np.float32),
+])
+def test_compute_payouts_from_arrays_matches_brute_force(mag_dtype, dist_dtype):
+    random_state = np.random.RandomState(0)
+    for _ in range(200):
+        n = random_state.randint(0, 50)
+        years = random_state.randint(1990, 2000, n).tolist()
+        mags_q = np.round(random_state.uniform(4, 8, n), 1).astype(mag_dtype)
+        dists_q = random_state.choice([5, 10, 30, 50, 100, 200, 250], n).astype(dist_dtype)
+
+        # overlapping tiers, possibly sharing a radius or a magnitude, 
+        # whose payouts are not monotonic in the radius nor in the magnitude
+        p = random_state.randint(0, 6)
+        radii = random_state.choice([10, 50, 100, 200], p).astype(np.float64)
+        mags_t = random_state.choice([4.5, 4.6, 5.5, 6.5, 7.0], p)
+        pay_t = random_state.randint(1, 100, p).astype(np.float64)
+
+        check_against_brute_force(years, mags_q, dists_q, radii, mags_t, pay_t)
+
+
+def test_compute_payouts_from_arrays_float32_magnitude_float64_distance():
+    # a float32 magnitude of 4.6 is below the float64 value 4.6, it must still reach a tier of magnitude 4.6
+    _, payouts = compute_payouts_from_arrays(
+        ['2000-06-01T00:00:00.000Z'], np.array([4.6], dtype=np.float32), np.array([30.0]), [50], [4.6], [75]
+    )
+    np.testing.assert_array_equal(payouts, [75])
+
+
+@pytest.mark.parametrize("payouts", [
+    (np.array([2000, 2001, 2005], dtype=np.int32), np.array([100.0, 0.0, 50.0])),
+    ([2000, 2001, 2005], [100, 0, 50]),
+    {2000: 100, 2001: 0, 2005: 50},
+    pd.Series({2000: 100, 2001: 0, 2005: 50}),
+])
+def test_compute_burning_cost(payouts):
+    np.testing.assert_allclose(compute_burning_cost(payouts, start_year=2000, end_year=2004), 20)
+    np.testing.assert_allclose(compute_burning_cost(payouts, start_year=2000, end_year=2009), 15)
+    with pytest.warns(UserWarning):
+        assert compute_burning_cost(payouts, start_year=2010, end_year=2020) is None
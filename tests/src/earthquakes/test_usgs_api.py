@@ -0,0 +1,217 @@
+import asyncio
+import collections
+import datetime
+import io
+import urllib.parse
+
+import aiohttp
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from earthquakes import usgs_api
+from earthquakes.usgs_api import USGS_CSV_COLUMNS, build_api_url, get_date_range, read_catalogue
+
+
+def test_build_api_url():
+    url = build_api_url(35.025, 25.763, 200, 4.5, "2021-10-21", "1821-10-21")
+
+    assert url == (
+        "https://earthquake.usgs.gov/fdsnws/event/1/query?format=csv"
+        "&starttime=1821-10-21&endtime=2021-10-21&minmagnitude=4.5"
+        "&latitude=35.025&longitude=25.763&maxradiuskm=200"
+    )
+
+
+def test_build_api_url_encodes_query():
+    url = build_api_url(-20, -175, 1000, 3, "2021-10-21", "1821-10-21")
+
+    base, query = url.split("?")
+    assert base == "https://earthquake.usgs.gov/fdsnws/event/1/query"
+    assert urllib.parse.parse_qs(query, strict_parsing=True) == {
+        "format": ["csv"],
+        "starttime": ["1821-10-21"],
+        "endtime": ["2021-10-21"],
+        "minmagnitude": ["3"],
+        "latitude": ["-20"],
+        "longitude": ["-175"],
+        "maxradiuskm": ["1000"],
+    }
+
+
+def test_get_date_range():
+    assert get_date_range(datetime.datetime(year=2021, month=10, day=21)) == ("1821-10-21", "2021-10-21")
+    assert get_date_range(datetime.datetime(year=2021, month=10, day=21), years=10) == ("2011-10-21", "2021-10-21")
+
+
+def test_get_date_range_29th_of_february():
+    # 1824 is a leap year, 1822 is not
+    assert get_date_range(datetime.datetime(year=2024, month=2, day=29)) == ("1824-02-29", "2024-02-29")
+    assert get_date_range(datetime.datetime(year=2024, month=2, day=29), years=202) == ("1822-02-28", "2024-02-29")
+
+
+HEADER = (
+    "time,latitude,longitude,depth,mag,magType,nst,gap,dmin,rms,net,id,updated,place,type,"
+    "horizontalError,depthError,magError,magNst,status,locationSource,magSource\n"
+)
+ROW = (
+    '2021-10-12T09:24:05.099Z,35.1691,26.2152,20,6.4,mww,,19,0.86,0.46,us,us6000ftxu,'
+    '2021-12-18T19:58:57.040Z,"4 km SW of Palekastro, Greece",earthquake,6.1,1.8,0.048,42,reviewed,us,us\n'
+)
+
+
+@pytest.mark.parametrize("float32", [False, True])
+def test_read_catalogue(float32):
+    table = read_catalogue((HEADER + ROW).encode(), float32)
+
+    assert table.column_names == USGS_CSV_COLUMNS
+    catalogue = table.to_pandas()
+    assert catalogue.loc[0, "time"] == "2021-10-12T09:24:05.099Z"
+    assert catalogue.loc[0, "id"] == "us6000ftxu"
+    assert catalogue["mag"].dtype == (np.float32 if float32 else np.float64)
+    assert catalogue["depth"].dtype == (np.float32 if float32 else np.float64)
+    assert catalogue["nst"].isna().all()
+
+
+@pytest.mark.parametrize("float32", [False, True])
+def test_read_catalogue_empty(float32):
+    # a region without any earthquake (204 No Content) or with only the header
+    empty = read_catalogue(b"", float32)
+    header_only = read_catalogue(HEADER.encode(), float32)
+    one_row = read_catalogue((HEADER + ROW).encode(), float32)
+
+    assert empty.num_rows == 0
+    assert header_only.num_rows == 0
+    assert empty.schema == header_only.schema == one_row.schema
+    assert pa.concat_tables([empty, one_row, header_only]).num_rows == 1
+
+
+@pytest.mark.parametrize("body", [b"", HEADER.encode()])
+def test_get_earthquake_data_empty_catalogue(monkeypatch, body):
+    monkeypatch.setattr(usgs_api.urllib.request, "urlopen", lambda url: io.BytesIO(body))
+
+    catalogue = usgs_api.get_earthquake_data()
+
+    assert isinstance(catalogue, pd.DataFrame)
+    assert len(catalogue) == 0
+    assert catalogue.columns.tolist() == USGS_CSV_COLUMNS
+    assert catalogue["mag"].dtype == np.float64
+
+
+def test_get_earthquake_data(monkeypatch):
+    monkeypatch.setattr(usgs_api.urllib.request, "urlopen", lambda url: io.BytesIO((HEADER + ROW).encode()))
+
+    catalogue = usgs_api.get_earthquake_data()
+
+    assert len(catalogue) == 1
+    assert catalogue.loc[0, "id"] == "us6000ftxu"
+
+
+def run_against_server(responses, test):
+    # serve responses[path] in turn to the requests of path (the last one repeatedly), 
+    # return what test(server) returned and the number of requests per path
+    calls = collections.Counter()
+
+    async def handler(request):
+        statuses = responses[request.path]
+        status, body = statuses[min(calls[request.path], len(statuses) - 1)]
+        calls[request.path] += 1
+        return web.Response(status=status, body=body)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/{region}", handler)
+        async with TestServer(app) as server:
+            return await test(server)
+
+    return asyncio.run(main()), calls
+
+
+async def fetch(server, path="/a"):
+    async with aiohttp.ClientSession() as session:
+        return await usgs_api.fetch_file(str(server.make_url(path)), session, asyncio.Semaphore(1))
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(usgs_api, "RETRY_BACKOFF", 0.001)
+
+
+@pytest.mark.parametrize("status", usgs_api.RETRY_STATUSES)
+def test_fetch_file_retries(no_backoff, status):
+    body = (HEADER + ROW).encode()
+    result, calls = run_against_server({"/a": [(status, b""), (status, b""), (200, body)]}, fetch)
+
+    assert result == body
+    assert calls["/a"] == 3
+
+
+async def fetch_status_raised(server):
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        await fetch(server)
+    return error.value.status
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_fetch_file_gives_up_after_max_retries(no_backoff, status):
+    raised, calls = run_against_server({"/a": [(status, b"")]}, fetch_status_raised)
+
+    assert raised == status
+    assert calls["/a"] == usgs_api.MAX_RETRIES + 1
+
+
+@pytest.mark.parametrize("status", [400, 404])
+def test_fetch_file_does_not_retry_other_statuses(no_backoff, status):
+    raised, calls = run_against_server({"/a": [(status, b""), (200, b"")]}, fetch_status_raised)
+
+    assert raised == status
+    assert calls["/a"] == 1
+
+
+def test_get_earthquake_data_for_multiple_locations_drops_failed_regions(monkeypatch, no_backoff):
+    assets = np.array([[35.025, 25.763], [-20, -175]])
+    responses = {"/35.025": [(200, (HEADER + ROW).encode())], "/-20.0": [(404, b"")]}
+
+    async def test(server):
+        # one region per path, named after its latitude
+        monkeypatch.setattr(
+            usgs_api, "build_api_url", lambda latitude, *args: str(server.make_url("/" + str(latitude)))
+        )
+        with pytest.warns(UserWarning, match="ClientResponseError"):
+            return await usgs_api.get_earthquake_data_for_multiple_locations(assets)
+
+    catalogue, calls = run_against_server(responses, test)
+
+    assert catalogue["id"].tolist() == ["us6000ftxu"]
+    assert calls == {"/35.025": 1, "/-20.0": 1}
+
+
+def test_get_earthquake_data_for_multiple_locations_drops_duplicates(monkeypatch):
+    # overlapping regions: the first earthquake is in the catalogues of both regions
+    rows = [ROW.replace("us6000ftxu", event_id).replace(",6.4,", "," + mag + ",") for event_id, mag in [
+        ("us1", "6.4"), ("us2", "5.0"), ("us3", "4.7"),
+    ]]
+    duplicate = rows[0].replace(",6.4,", ",6.5,")
+    catalogues = {
+        "35.025": (HEADER + rows[0] + rows[1]).encode(),
+        "-20.0": (HEADER + rows[2] + duplicate).encode(),
+    }
+
+    async def fetch_file(url, session, semaphore):
+        return catalogues[url]
+
+    monkeypatch.setattr(usgs_api, "build_api_url", lambda latitude, *args: str(latitude))
+    monkeypatch.setattr(usgs_api, "fetch_file", fetch_file)
+
+    catalogue = asyncio.run(
+        usgs_api.get_earthquake_data_for_multiple_locations(np.array([[35.025, 25.763], [-20, -175]]))
+    )
+
+    assert catalogue["id"].tolist() == ["us1", "us2", "us3"]
+    # the first occurrence of a duplicated earthquake is kept
+    assert catalogue["mag"].tolist() == [6.4, 5.0, 4.7]
+    assert isinstance(catalogue.index, pd.RangeIndex)
+    assert catalogue.index.tolist() == [0, 1, 2]